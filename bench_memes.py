@@ -0,0 +1,62 @@
+"""
+Measures encode time and size of memes for different output settings.
+
+$ python bench_memes.py --poster poster.jpg --runs 20
+"""
+
+import io
+from argparse import ArgumentParser
+from time import perf_counter
+
+from PIL import Image
+
+import memes
+
+OPTIONS = [
+    ("PNG", None, 0),
+    ("JPEG", 95, 0),
+    ("JPEG", 85, 0),
+    ("JPEG", 95, 50_000),
+    ("JPEG", 70, 0),
+    ("WEBP", 85, 0),
+    ("WEBP", 85, 35_000),
+    ("WEBP", 70, 0),
+]
+
+parser = ArgumentParser()
+parser.add_argument("--poster", help="A poster image, a synthetic one by default.")
+parser.add_argument("--runs", default=10, type=int)
+args = parser.parse_args()
+
+
+def synthetic_poster():
+    gradient = Image.linear_gradient("L").resize((230, 345))
+    noise = Image.effect_noise((230, 345), 40)
+    poster = Image.merge("RGB", (gradient, noise, gradient.rotate(180)))
+    bio = io.BytesIO()
+    poster.save(bio, format="JPEG")
+    bio.seek(0)
+    return bio
+
+
+def bench(name, creator, poster):
+    # Lossless source, so every option starts from the same pixels.
+    image = Image.open(creator("username", poster, format="PNG"))
+    image.load()
+    for format, quality, max_bytes in OPTIONS:
+        start = perf_counter()
+        for _ in range(args.runs):
+            bio = memes._image_to_bytes(image, format, quality, max_bytes)
+        elapsed = (perf_counter() - start) / args.runs * 1000
+        size = bio.getbuffer().nbytes / 1000
+        option = f"{format} q={quality} max={max_bytes}"
+        print(f"{name:<5} {option:<25} {elapsed:>7.1f} ms {size:>7.1f} kB")
+
+
+if __name__ == "__main__":
+    poster = open(args.poster, "rb").read() if args.poster else None
+    for name, creator in [
+        ("high", memes.create_high_rating_meme),
+        ("low", memes.create_low_rating_meme),
+    ]:
+        bench(name, creator, io.BytesIO(poster) if poster else synthetic_poster())
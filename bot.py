@@ -1,18 +1,28 @@
 import asyncio
 import re
+import signal
 from argparse import ArgumentParser
+from contextlib import suppress
 from datetime import datetime
+from html import escape
 
 from telethon import TelegramClient, events
 from telethon.hints import EntityLike
 
 # from telethon.tl.functions.messages import SendReactionRequest
 # from telethon.tl.types import ReactionEmoji
-from telethon.types import MessageEntityUrl, PeerChannel
-from telethon.utils import split_text
+from telethon.types import MessageEntityUrl, PeerChannel, TypeMessageEntity
 
+import history
 import letterboxd
+import link_resolver
+import loop_monitor
+import memes
+import packing
+import profiling
 import settings
+import sharding
+import snapshot
 from custom_html_parser import CustomHtmlParser
 
 _LETTERBOXD_OR_BOXD = re.compile(
@@ -20,14 +30,12 @@ _LETTERBOXD_OR_BOXD = re.compile(
 )
 
 current_task = None
-
-client = TelegramClient(
-    settings.session,  # type: ignore
-    settings.api_id,
-    settings.api_hash,  # type: ignore
-)
-client.start(phone=settings.phone_number)  # type: ignore
-client.parse_mode = CustomHtmlParser()  # type: ignore
+# Packed messages that are due but not sent yet, with their failed attempts.
+# Saved with every change, since their entries already count as delivered.
+outbox: list[tuple[EntityLike, str, list[TypeMessageEntity], int]] = []
+# A message that still fails after this many cycles is dropped, so it can't
+# hold up the ones after it.
+_SEND_ATTEMPTS = 3
 
 parser = ArgumentParser()
 parser.add_argument(
@@ -42,15 +50,74 @@ parser.add_argument(
     type=bool,
     help="Debug mode sends updates to Saved Messages once.",
 )
+parser.add_argument(
+    "--catch-up",
+    action="store_true",
+    help=(
+        "Send a digest of everything missed since the last delivery first. "
+        "Past the RSS feed it reads up to 20 diary pages, which only have days: "
+        "entries viewed on or before the day of the last delivery are left out."
+    ),
+)
+parser.add_argument(
+    "--deadline",
+    default=120,
+    type=int,
+    help=(
+        "Seconds a cycle has before likes, list sizes and memes are skipped, "
+        "0 for no limit."
+    ),
+)
+parser.add_argument(
+    "--profile",
+    default=0,
+    type=int,
+    help="The number of first cycles to profile into profiles/.",
+)
+parser.add_argument(
+    "--workers",
+    default=0,
+    type=int,
+    help=(
+        "The number of processes to shard users across, started once at launch, "
+        "0 to run in-process."
+    ),
+)
+parser.add_argument(
+    "--block-threshold",
+    default=0.5,
+    type=float,
+    help="Report anything that blocks the event loop longer, in seconds.",
+)
 args = parser.parse_args()
 
+# Forked before the client connects and before any thread starts.
+pool = sharding.ShardedUpdatesManager(args.age, args.workers) if args.workers else None
+
+client = TelegramClient(
+    settings.session,  # type: ignore
+    settings.api_id,
+    settings.api_hash,  # type: ignore
+)
+client.start(phone=settings.phone_number)  # type: ignore
+client.parse_mode = CustomHtmlParser()  # type: ignore
+
+activity = history.ActivityHistory()
+profiler = profiling.Profiler()
+profiler.arm("cycle", args.profile)
+monitor = loop_monitor.LoopMonitor(client.loop, threshold=args.block_threshold)
+
 
 def time_logger(func):
     async def wrapper(*args, **kwargs):
         start_time = datetime.now()
         result = await func(*args, **kwargs)
         end_time = datetime.now()
-        print(f"{end_time.strftime('%H:%M:%S')} - {(end_time - start_time).seconds}s")
+        shed = ""
+        if isinstance(result, letterboxd.Deadline) and result.shed:
+            shed = f", shed {', '.join(sorted(result.shed))}"
+        elapsed = (end_time - start_time).seconds
+        print(f"{end_time.strftime('%H:%M:%S')} - {elapsed}s{shed}")
         return result
 
     return wrapper
@@ -67,21 +134,48 @@ def time_logger(func):
 #     )
 
 
-@client.on(events.NewMessage())
-async def letterboxd_link_handler(event):  # sourcery skip: last-if-guard
-    if event.message.entities and (
-        event.is_group and event.mentioned or event.message.is_private
-    ):
-        for entity in event.message.entities:
-            if isinstance(entity, MessageEntityUrl):
-                url = event.raw_text[entity.offset : entity.offset + entity.length]
-                if match := re.search(_LETTERBOXD_OR_BOXD, url):
-                    url = f"https://{match[1]}"
-                    try:
-                        if link := letterboxd.letterboxd_to_link(url):
-                            await event.reply(link)
-                    except AttributeError:
-                        print("Неправильне посилання.")
+async def _resolve_link(url: str) -> str | None:
+    if profiler.armed("link"):
+        # cProfile only sees its own thread, so a profiled link blocks the loop.
+        async with profiler.profile("link"):
+            return letterboxd.letterboxd_to_link(url)
+    return await asyncio.to_thread(letterboxd.letterboxd_to_link, url)
+
+
+resolver = link_resolver.LinkResolver(_resolve_link, client.loop)
+
+
+def _may_have_letterboxd_link(event) -> bool:
+    message = event.message
+    return (
+        bool(message.entities)
+        and "boxd" in message.message
+        and (event.is_group and event.mentioned or message.is_private)
+    )
+
+
+@client.on(
+    events.NewMessage(
+        chats=settings.link_chats or None,
+        func=_may_have_letterboxd_link,
+    )
+)
+async def letterboxd_link_handler(event):
+    resolutions = []
+    for entity in event.message.entities:
+        if isinstance(entity, MessageEntityUrl):
+            url = event.raw_text[entity.offset : entity.offset + entity.length]
+            if match := re.search(_LETTERBOXD_OR_BOXD, url):
+                resolutions.append(
+                    resolver.submit(event.chat_id, f"https://{match[1]}")
+                )
+
+    for resolution in filter(None, resolutions):
+        try:
+            if link := await resolution:
+                await event.reply(link)
+        except AttributeError:
+            print("Неправильне посилання.")
 
 
 @client.on(events.NewMessage(pattern=r"^>add (\w+)"))
@@ -106,7 +200,60 @@ async def age_handler(event):
         except asyncio.CancelledError:
             print(f"Restarting main() with age_minutes={new_age}")
 
-    current_task = client.loop.create_task(main(age_minutes=new_age))
+    current_task = client.loop.create_task(main(age_minutes=new_age, catch_up=False))
+
+
+@client.on(
+    events.NewMessage(
+        pattern=r"^>profile(?: (cycle|link))?(?: (\d+))?$",
+        from_users=settings.owner,
+    )
+)
+async def profile_handler(event):
+    kind = event.pattern_match.group(1) or "cycle"
+    count = int(event.pattern_match.group(2) or 1)
+
+    async def report(path, summary):
+        await event.respond(f"<b>{path}</b>\n<pre>{escape(summary)}</pre>")
+
+    profiler.arm(kind, count, report)
+    await event.reply(f"Профілюю наступні {count} ({kind}).")
+
+
+@client.on(events.NewMessage(pattern=r"^>workers (\d+)$", from_users=settings.owner))
+async def workers_handler(event):
+    workers = int(event.pattern_match.group(1))
+
+    if not pool:
+        await event.reply("Шардинг вмикається при запуску з --workers.")
+    elif 0 < workers <= pool.workers:
+        pool.resize(workers)
+        await event.reply(f"Воркерів: {workers}.")
+    else:
+        await event.reply(
+            f"Можна від 1 до {pool.workers} воркерів, "
+            "більше — після перезапуску з більшим --workers."
+        )
+
+
+@client.on(events.NewMessage(pattern=r"^>lag$", from_users=settings.owner))
+async def lag_handler(event):
+    await event.reply(f"<pre>{escape(monitor.format())}</pre>")
+
+
+@client.on(events.NewMessage(pattern=r"^>top$"))
+async def top_handler(event):
+    await event.reply(activity.format_top())
+
+
+@client.on(events.NewMessage(pattern=r"^>avg (\w+)$"))
+async def average_handler(event):
+    await event.reply(activity.format_average(event.pattern_match.group(1)))
+
+
+@client.on(events.NewMessage(pattern=r"^>common (.+)$"))
+async def common_handler(event):
+    await event.reply(activity.format_common(event.pattern_match.group(1).strip()))
 
 
 @client.on(events.NewMessage(pattern=r"^ping$"))
@@ -115,47 +262,144 @@ async def ping_handler(event):
 
 
 @time_logger
+@profiler.profiled("cycle")
 async def send_letterboxd_updates(
     destination: EntityLike,
-    manager: letterboxd.RssUpdatesManager,
+    manager: letterboxd.RssUpdatesManager | sharding.ShardedUpdatesManager,
     users: list[str] = settings.users,
-) -> None:
-    if not (updates := await manager.fetch_updates_from_users(users)):
-        return
-
-    feeds = manager.format_feeds(updates)
-
-    uploads = [
-        client.upload_file(picture)
-        for picture in await letterboxd.create_memes(updates)
-    ]
-    files = await asyncio.gather(*uploads)
-
-    text, entities = CustomHtmlParser.parse(feeds)
-    messages = split_text(text, entities, split_at=(r"\n\n", r"\n"))
-
-    if files:
-        await client.send_file(destination, files)
-
-    for message, entities in messages:
-        await client.send_message(
-            destination,
-            message,
-            formatting_entities=entities,
-            link_preview=False,
+    digest: bool = False,
+    debug: bool = False,
+) -> letterboxd.Deadline:
+    deadline = letterboxd.Deadline(args.deadline or None)
+    updates, pictures = await manager.prepare_updates(
+        users, settings.delivered, digest, deadline
+    )
+
+    if updates:
+        files = []
+        if pictures and deadline.allows("memes"):
+            uploads = asyncio.gather(*[client.upload_file(p) for p in pictures])
+            try:
+                files = await asyncio.wait_for(uploads, deadline.remaining("memes"))
+            except asyncio.TimeoutError:
+                deadline.shed.add("memes")
+
+        messages = packing.pack_messages(
+            [feed.to_message() for feed in updates if feed]
         )
-
-
-async def main(age_minutes: int = args.age, debug: bool = args.debug):
+        outbox.extend((destination, text, entities, 0) for text, entities in messages)
+        _save_outbox()
+
+        # Queued messages outlive restarts, so the entries count as delivered.
+        # Debug runs go to Saved Messages and must not hide them from the chat.
+        if not debug:
+            for feed in updates:
+                settings.mark_delivered(feed.username, feed.latest)
+            settings.save_delivered()
+            activity.record(updates)
+
+        if files:
+            try:
+                await client.send_file(destination, files)
+            except Exception as e:
+                print(f"Memes not sent: {e}")
+
+    while outbox:
+        chat, message, entities, attempts = outbox[0]
+        try:
+            await client.send_message(
+                chat,
+                message,
+                formatting_entities=entities,
+                link_preview=False,
+            )
+        except Exception as e:
+            attempts += 1
+            if attempts < _SEND_ATTEMPTS:
+                print(f"Sending failed, retrying next cycle: {e}")
+                outbox[0] = (chat, message, entities, attempts)
+                _save_outbox()
+                break
+            print(f"Sending failed {attempts} times, dropping the message: {e}")
+
+        outbox.pop(0)
+        _save_outbox()
+
+    return deadline
+
+
+async def main(
+    age_minutes: int = args.age,
+    debug: bool = args.debug,
+    catch_up: bool = args.catch_up,
+):
     destination = await client.get_me() if debug else PeerChannel(settings.chat_id)
-    manager = letterboxd.RssUpdatesManager(age_minutes)
+    if pool:
+        pool.age = age_minutes
+        manager = pool
+    else:
+        manager = letterboxd.RssUpdatesManager(age_minutes, settings.meme_encoding)
+
+    if catch_up:
+        missed = [user for user in settings.users if user in settings.delivered]
+        await send_letterboxd_updates(
+            destination, manager, missed, digest=True, debug=debug
+        )
 
     while True:
-        await send_letterboxd_updates(destination, manager)
+        await send_letterboxd_updates(destination, manager, debug=debug)
         await asyncio.sleep(age_minutes * 60)
 
 
+def _load_snapshot() -> None:
+    state = snapshot.load(settings.snapshot_file)
+    letterboxd.set_state(state.get("letterboxd", {}))
+    memes.set_state(state.get("memes", {}))
+    resolver.set_state(state.get("links", {}))
+    outbox.extend(snapshot.load(settings.outbox_file).get("outbox", []))
+
+
+def _save_snapshot() -> None:
+    state = {
+        "letterboxd": letterboxd.get_state(),
+        "memes": memes.get_state(),
+        "links": resolver.get_state(),
+    }
+    snapshot.save(settings.snapshot_file, state)
+
+
+def _save_outbox() -> None:
+    snapshot.save(settings.outbox_file, {"outbox": outbox})
+
+
+async def shutdown(signum: int) -> None:
+    if current_task:
+        current_task.cancel()
+        try:
+            await current_task
+        except (asyncio.CancelledError, Exception):
+            pass
+
+    # Saved first, a worker that won't exit can't cost the main snapshot.
+    _save_snapshot()
+    if pool:
+        pool.close()
+    await client.disconnect()  # type: ignore
+
+    # After SIGHUP the terminal may be gone, and printing fails with EIO.
+    with suppress(OSError):
+        print(f"{signal.Signals(signum).name}, saved the snapshot and exited.")
+
+
 if __name__ == "__main__":
     with client:
+        _load_snapshot()
+        # The deploy sends SIGTERM, closing the screen session sends SIGHUP.
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            client.loop.add_signal_handler(
+                signum, lambda signum=signum: client.loop.create_task(shutdown(signum))
+            )
+        monitor.start()
+        resolver.start()
         current_task = client.loop.create_task(main())
         client.run_until_disconnected()
@@ -0,0 +1,176 @@
+import heapq
+import json
+import os
+import re
+from html import escape
+
+import letterboxd
+
+_FILM_SLUG = re.compile(r"\/film\/([^\/]+)")
+
+
+class _Tally:
+    """
+    Attributes
+    ----------
+    logs : int
+    rated : int
+    total : float
+    """
+
+    def __init__(self) -> None:
+        self.logs = 0
+        self.rated = 0
+        self.total = 0.0
+
+    @property
+    def average(self) -> float | None:
+        return self.total / self.rated if self.rated else None
+
+    def add(self, rating: float | None) -> None:
+        self.logs += 1
+        if rating is not None:
+            self.rated += 1
+            self.total += rating
+
+
+class _Film:
+    """
+    Attributes
+    ----------
+    title : str
+    ratings : dict[str, float | None]
+        The latest rating of every user who logged the film.
+    """
+
+    def __init__(self, title: str) -> None:
+        self.title = title
+        self.ratings = {}
+
+    @property
+    def average(self) -> float | None:
+        # One rating per user, so rewatches don't outweigh everyone else.
+        rated = [rating for rating in self.ratings.values() if rating is not None]
+        return sum(rated) / len(rated) if rated else None
+
+    def add_log(self, user: str, rating: float | None) -> None:
+        if rating is not None or user not in self.ratings:
+            self.ratings[user] = rating
+
+
+class ActivityHistory:
+    """
+    Append-only history of delivered diary entries, one JSON array per line:
+    [timestamp, user, film slug, title, rating, rewatch, liked]. Aggregates
+    are rebuilt once on load and then updated with every appended entry.
+
+    Attributes
+    ----------
+    path : str
+    """
+
+    def __init__(self, path: str = "history.jsonl") -> None:
+        self.path = path
+        self._users: dict[str, _Tally] = {}
+        self._films: dict[str, _Film] = {}
+        self._titles: dict[str, str] = {}
+        self._load()
+
+    def record(self, feeds: list[letterboxd.UserFeed]) -> None:
+        rows = [
+            self._to_row(feed.username, entry)
+            for feed in feeds
+            for entry in feed
+            if isinstance(entry, letterboxd.MovieLog)
+        ]
+        if not rows:
+            return
+
+        # One write, so a kill can only tear the last line.
+        with open(self.path, "a") as f:
+            f.write("".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows))
+        for row in rows:
+            self._apply(row)
+
+    def format_top(self, limit: int = 10) -> str:
+        films = heapq.nlargest(
+            limit,
+            self._films.values(),
+            key=lambda film: (len(film.ratings), film.average or 0),
+        )
+        if not films:
+            return "Історія порожня."
+
+        lines = [
+            f"{len(film.ratings)} 👤 {_stars(film.average)} {escape(film.title)}"
+            for film in films
+        ]
+        return "\n".join(["<b>Найпопулярніше:</b>", *lines])
+
+    def format_average(self, user: str) -> str:
+        if not (tally := self._users.get(user)):
+            return f"Немає записів від {escape(user)}."
+
+        return (
+            f"<b>{escape(user)}</b>: {tally.logs} записів, "
+            f"середня оцінка {_stars(tally.average)}"
+        )
+
+    def format_common(self, film: str) -> str:
+        slug = self._titles.get(film.lower(), film.lower())
+        if not (stats := self._films.get(slug)):
+            return f"Ніхто не дивився {escape(film)}."
+
+        lines = [
+            f"{escape(user)} {_stars(rating)}" for user, rating in stats.ratings.items()
+        ]
+        return "\n".join([f"<b>{escape(stats.title)}:</b>", *lines])
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, "rb+") as f:
+            end = 0
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # Cut off an append that was killed halfway, so the next
+                    # one starts on a line of its own.
+                    print(f"{self.path}: dropped an unfinished last line")
+                    f.truncate(end)
+                    break
+                end += len(line)
+                if line.strip():
+                    self._apply(json.loads(line))
+
+    def _apply(self, row: list) -> None:
+        _, user, slug, title, rating, _, _ = row
+        if (tally := self._users.get(user)) is None:
+            tally = self._users[user] = _Tally()
+        if (film := self._films.get(slug)) is None:
+            film = self._films[slug] = _Film(title)
+            self._titles[title.lower()] = slug
+
+        tally.add(rating)
+        film.add_log(user, rating)
+
+    @staticmethod
+    def _to_row(user: str, entry: letterboxd.MovieLog) -> list:
+        match = re.search(_FILM_SLUG, entry.link)
+        return [
+            int(entry.published.timestamp()),
+            user,
+            match[1] if match else entry.link,
+            entry.title,
+            float(entry.rating) if entry.rating else None,
+            int(bool(entry.is_rewatch)),
+            int(entry.is_liked),
+        ]
+
+
+def _stars(rating: float | None) -> str:
+    if rating is None:
+        return "—"
+    halves = round(rating * 2)
+    stars = "★" * (halves // 2) + "½" * (halves % 2)
+    return stars if halves == rating * 2 else f"{stars} ({rating:.2f})"
@@ -1,20 +1,79 @@
 import asyncio
 import io
 import re
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from random import shuffle
 
 import aiohttp
 import requests
 from bs4 import BeautifulSoup, PageElement
+from telethon.types import TypeMessageEntity
 
 import memes
+from custom_html_parser import CustomHtmlParser
 
 # from fake_useragent import UserAgent
 
 
 _MOVIE_OR_LOG = re.compile(r"(https\:\/\/letterboxd\.com\/).*(film\/.+\/?)")
 
+# Letterboxd's RSS only has the latest entries of a user, older ones are read
+# from the diary, up to a page limit.
+_RSS_SIZE = 50
+_DIARY_PAGES = 20
+# aiohttp's default limit, catch-up digests fetch far more pages at once.
+_CONNECTIONS = 100
+_DIGEST_CONNECTIONS = 8
+
+# ETag, Last-Modified and the body of every feed, for conditional requests.
+_validators: dict[str, tuple[str | None, str | None, bytes]] = {}
+# Recently downloaded posters, the same films tend to come up again.
+_POSTERS_SIZE = 64
+_posters: OrderedDict[str, bytes] = OrderedDict()
+# aiohttp's default, and the least a request gets even in a late cycle.
+_DEFAULT_TIMEOUT = 5 * 60
+_MIN_TIMEOUT = 5
+
+
+class Deadline:
+    """
+    Time budget of a cycle. Optional work is shed once less than its share
+    of the budget is left, so likes and list sizes go first, then memes;
+    the text updates are always sent.
+
+    Attributes
+    ----------
+    seconds : float | None
+    expires_at : float | None
+    shed : set[str]
+    """
+
+    _SHED_AT = {"metadata": 0.5, "memes": 0.25}
+
+    def __init__(self, seconds: float | None = None) -> None:
+        self.seconds = seconds
+        # Wall time, so worker processes can share it.
+        self.expires_at = time.time() + seconds if seconds is not None else None
+        self.shed = set()
+
+    def remaining(self, work: str | None = None) -> float | None:
+        """Seconds left for the given work or the whole cycle, None if unlimited."""
+        if self.seconds is None or self.expires_at is None:
+            return None
+
+        reserve = self.seconds * self._SHED_AT[work] if work else 0
+        return max(0.0, self.expires_at - reserve - time.time())
+
+    def allows(self, work: str) -> bool:
+        remaining = self.remaining(work)
+        if remaining is None or remaining > 0:
+            return True
+
+        self.shed.add(work)
+        return False
+
 
 class MovieLog:
     """
@@ -24,6 +83,7 @@ class MovieLog:
     title : str
     is_liked : bool
     is_rewatch : bool
+    published : datetime
     year: str | None
     rating : str | None
     review : str | None
@@ -64,6 +124,12 @@ class MovieLog:
         self._parse_metadata()
         self._parse_review()
 
+    def __getstate__(self) -> dict:
+        # Parsed soup is too deep to pickle, the feed keeps its message instead.
+        state = self.__dict__.copy()
+        del state["_entry"], state["_unformatted_review"]
+        return state
+
     async def get_advanced_metadata(self, session: aiohttp.ClientSession) -> None:
         if response := await _make_request(session, self.link):
             log = BeautifulSoup(response, features="html.parser")
@@ -71,7 +137,7 @@ class MovieLog:
         else:
             self.is_liked = False
 
-    def format(self) -> str:
+    def format(self, compact: bool = False) -> str:
         year = f" ({self.year})" if self.year else ""
         rewatch = "🔄" if self.is_rewatch else ""
         heart = "❤️" if self.is_liked else ""
@@ -85,7 +151,9 @@ class MovieLog:
         )
         prefix = " ".join(filter(bool, prefix_components))
 
-        review = self._format_review(self._unformatted_review, self.has_spoilers)
+        review = None
+        if not compact:
+            review = self._format_review(self._unformatted_review, self.has_spoilers)
         if review:
             review = f"\n<blockquote expandable>{review}<blockquote expandable/>"
         else:
@@ -98,6 +166,8 @@ class MovieLog:
 
     def _parse_metadata(self) -> None:
         self.link = self._entry.find("link").text  # type: ignore
+        self.published = _published(self._entry)
+        self.is_liked = False
 
         self.title = self._entry.find("letterboxd:filmTitle").text  # type: ignore
         self.year = (
@@ -170,12 +240,69 @@ class MovieLog:
         return formatted_review if (formatted_review := str(review)) else None
 
 
+class DiaryLog(MovieLog):
+    """
+    A diary entry from past the RSS window. The diary only has the day of a
+    viewing, and no review or poster.
+
+    Attributes
+    ----------
+    viewing_id : str | None
+    """
+
+    _DAY = re.compile(r"\/for\/(\d{4})\/(\d{2})\/(\d{2})\/")
+    _RATED = re.compile(r"^rated-(\d+)$")
+
+    def __init__(self, row: PageElement, tzinfo) -> None:
+        self._tzinfo = tzinfo
+        super().__init__(row)
+
+    def _parse_metadata(self) -> None:
+        row = self._entry
+        film = row.find("h3").find("a")  # type: ignore
+        self.link = f"https://letterboxd.com{film['href']}"  # type: ignore
+        self.title = film.text.strip()  # type: ignore
+        self.year = (
+            released.text.strip() or None
+            if (released := row.find("td", class_="td-released"))  # type: ignore
+            else None
+        )
+
+        viewing = row.find(attrs={"data-viewing-id": True}) or row  # type: ignore
+        self.viewing_id = viewing.get("data-viewing-id")  # type: ignore
+        if date := viewing.get("data-viewing-date"):  # type: ignore
+            day = datetime.strptime(date, "%Y-%m-%d")  # type: ignore
+        else:
+            href = row.find("td", class_="td-day").find("a")["href"]  # type: ignore
+            day = datetime(*map(int, re.search(self._DAY, href).groups()))  # type: ignore
+        self.published = day.replace(tzinfo=self._tzinfo)
+
+        rated = row.find("span", class_=self._RATED)  # type: ignore
+        classes = rated["class"] if rated else []  # type: ignore
+        half_stars = next(
+            (int(match[1]) for c in classes if (match := self._RATED.match(c))), 0
+        )
+        self.rating = f"{half_stars / 2:.1f}" if half_stars else None
+
+        self.is_liked = bool(row.find(class_="icon-liked"))  # type: ignore
+        rewatch = row.find("td", class_="td-rewatch")  # type: ignore
+        self.is_rewatch = (
+            "icon-status-off" not in rewatch["class"] if rewatch else None  # type: ignore
+        )
+
+    def _parse_review(self) -> None:
+        self.poster_url = None
+        self.has_spoilers = False
+        self._unformatted_review = BeautifulSoup("", features="html.parser")
+
+
 class ListLog:
     """
     Attributes
     ----------
     link : str
     title: str
+    published : datetime
     size: int | None
     """
 
@@ -185,6 +312,11 @@ class ListLog:
         self._entry = entry
         self._parse_metadata()
 
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        del state["_entry"]
+        return state
+
     async def get_advanced_metadata(self, session: aiohttp.ClientSession) -> None:
         if response := await _make_request(session, self.link):
             log = BeautifulSoup(response, features="html.parser")
@@ -194,13 +326,15 @@ class ListLog:
         else:
             self.size = None
 
-    def format(self) -> str:
+    def format(self, compact: bool = False) -> str:
         size = f" ({self._decline_size(self.size)})" if self.size else ""
         return f'🆕 🎬 <a href="{self.link}"><i>{self.title}</i>{size}</a>'
 
     def _parse_metadata(self) -> None:
         self.link = self._entry.find("link").text  # type: ignore
+        self.published = _published(self._entry)
         self.title = self._entry.find("title").text  # type: ignore
+        self.size = None
 
     @staticmethod
     def _decline_size(size: int) -> str:
@@ -221,7 +355,9 @@ class UserFeed(list[MovieLog | ListLog]):
     ----------
     user_link : str
     name : str
-    cutoff_time : datetime | None
+    username : str
+    compact : bool
+    truncated : bool
     """
 
     _USER_LINK = re.compile(r"(https:\/\/letterboxd\.com\/[^\/]+\/)")
@@ -231,14 +367,42 @@ class UserFeed(list[MovieLog | ListLog]):
         entries: list[MovieLog | ListLog],
         user_link: str,
         name: str,
+        username: str,
+        compact: bool = False,
+        truncated: bool = False,
     ) -> None:
         super().__init__(entries)
         self.name = name
         self.user_link = user_link
+        self.username = username
+        self.compact = compact
+        self.truncated = truncated
+        self._message = None
+
+    @property
+    def latest(self) -> datetime:
+        return max(entry.published for entry in self)
 
     def format(self) -> str:
         prefix = f'<b>Оновлення від <a href="{self.user_link}">{self.name}</a>:</b>'
-        return "\n".join([prefix, *[entry.format() for entry in self]])
+        entries = [entry.format(self.compact) for entry in self]
+        if self.truncated:
+            entries.append(f'<a href="{self.user_link}films/diary/">Раніше…</a>')
+        return "\n".join([prefix, *entries])
+
+    def to_message(self) -> tuple[str, list[TypeMessageEntity]]:
+        """
+        Formats and parses the feed into (text, entities) once; later calls
+        reuse the result, so the feed must be complete before the first call.
+        """
+        if self._message is None:
+            self._message = CustomHtmlParser.parse(self.format())
+        return self._message
+
+    def __getstate__(self) -> dict:
+        # Entries can't be formatted once pickled, so the message goes along.
+        self.to_message()
+        return self.__dict__.copy()
 
 
 class RssUpdatesManager:
@@ -246,34 +410,79 @@ class RssUpdatesManager:
     Attributes
     ----------
     cutoff_time : datetime
+    meme_encoding : dict
+        Format, quality and byte budget of the memes.
     """
 
-    def __init__(self, max_age_minutes: int):
+    def __init__(self, max_age_minutes: int, meme_encoding: dict | None = None):
         self.age = max_age_minutes
+        self.meme_encoding = meme_encoding or {}
 
-    async def fetch_updates_from_users(self, usernames: list[str]) -> list[UserFeed]:
+    async def fetch_updates_from_users(
+        self,
+        usernames: list[str],
+        since: dict[str, datetime] | None = None,
+        digest: bool = False,
+        deadline: Deadline | None = None,
+    ) -> list[UserFeed]:
+        """
+        Entries older than a user's last delivered one in `since` are skipped.
+        A digest collects everything after it regardless of the age, with
+        compact formatting and fewer connections at a time.
+        """
+        deadline = deadline or Deadline()
+        connections = _DIGEST_CONNECTIONS if digest else _CONNECTIONS
         shuffle(usernames)
         urls = [f"https://letterboxd.com/{username}/rss" for username in usernames]
-        responses: list = await _fetch_all(urls)
+        responses: list = await _fetch_all(
+            urls, connections, _validators, deadline.remaining()
+        )
 
-        return await self._create_user_feeds(list(filter(bool, responses)))
+        return await self._create_user_feeds(
+            [(user, rss) for user, rss in zip(usernames, responses) if rss],
+            since or {},
+            digest,
+            deadline,
+        )
 
-    @staticmethod
-    def format_feeds(user_feeds: list[UserFeed]) -> str:
-        return "\n\n".join(
-            [user_feed.format() for user_feed in user_feeds if user_feed]
+    async def prepare_updates(
+        self,
+        usernames: list[str],
+        since: dict[str, datetime] | None = None,
+        digest: bool = False,
+        deadline: Deadline | None = None,
+    ) -> tuple[list[UserFeed], list[io.BytesIO]]:
+        updates = await self.fetch_updates_from_users(
+            usernames, since, digest, deadline
         )
+        if digest:
+            return updates, []
+        return updates, await create_memes(updates, deadline, **self.meme_encoding)
 
-    async def _create_user_feeds(self, responses: list):
+    async def _create_user_feeds(
+        self,
+        responses: list[tuple[str, bytes]],
+        since: dict[str, datetime],
+        digest: bool,
+        deadline: Deadline,
+    ) -> list[UserFeed]:
         user_feeds = []
-        cutoff_time = datetime.now().astimezone() - timedelta(minutes=self.age)
+        behind = []
+        age_cutoff = datetime.now().astimezone() - timedelta(minutes=self.age)
+        connections = _DIGEST_CONNECTIONS if digest else _CONNECTIONS
 
-        for rss in responses:
+        for username, rss in responses:
             xml = BeautifulSoup(rss, features="xml")
 
             user_link = xml.find("link").text  # type: ignore
             name = xml.find("title").text.removeprefix("Letterboxd - ")  # type: ignore
 
+            cutoff_time = age_cutoff
+            if last_delivered := since.get(username):
+                cutoff_time = (
+                    last_delivered if digest else max(age_cutoff, last_delivered)
+                )
+
             all_entries = xml.find_all("item")
             new_entries = list(
                 filter(
@@ -283,35 +492,122 @@ class RssUpdatesManager:
             )
 
             if new_entries:
-                user_feed = UserFeed([], user_link, name)
+                # Older entries than the whole RSS window may have been missed.
+                truncated = (
+                    digest
+                    and len(all_entries) >= _RSS_SIZE
+                    and len(new_entries) == len(all_entries)
+                )
+                user_feed = UserFeed([], user_link, name, username, digest, truncated)
 
                 for entry in new_entries:
                     user_feed.append(
                         MovieLog(entry) if "w" in entry.guid.text else ListLog(entry)
                     )
 
-                async with aiohttp.ClientSession() as session:
-                    tasks = [log.get_advanced_metadata(session) for log in user_feed]
-                    await asyncio.gather(*tasks)
+                if deadline.allows("metadata"):
+                    await self._get_advanced_metadata(user_feed, connections, deadline)
+
+                if truncated and last_delivered:
+                    # Watches and reviews end their GUIDs with the viewing ID.
+                    seen = {
+                        entry.guid.text.rsplit("-", 1)[-1]
+                        for entry in all_entries
+                        if "w" in entry.guid.text
+                    }
+                    seen |= {entry.link for entry in user_feed}
+                    behind.append((user_feed, last_delivered, seen))
 
                 user_feeds.append(user_feed)
 
+        if behind:
+            await self._read_diaries(behind, deadline)
+
         return user_feeds
 
+    async def _read_diaries(
+        self,
+        behind: list[tuple[UserFeed, datetime, set[str]]],
+        deadline: Deadline,
+    ) -> None:
+        """
+        Extends the feeds whose whole RSS window is new with the diary entries
+        after their last delivery. A feed keeps its link to the diary when its
+        pages run out, fail or don't parse, or when the cycle runs out of time.
+        """
+        connector = aiohttp.TCPConnector(limit=_DIGEST_CONNECTIONS)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            tasks = [self._read_diary(session, *feed) for feed in behind]
+            try:
+                await asyncio.wait_for(asyncio.gather(*tasks), deadline.remaining())
+            except asyncio.TimeoutError:
+                deadline.shed.add("diary")
+
+    @staticmethod
+    async def _read_diary(
+        session: aiohttp.ClientSession,
+        user_feed: UserFeed,
+        since: datetime,
+        seen: set[str],
+    ) -> None:
+        # The diary only has days, so the day of the last delivery is left out
+        # rather than risk sending its entries twice.
+        for page in range(1, _DIARY_PAGES + 1):
+            url = f"{user_feed.user_link}films/diary/page/{page}/"
+            if not (response := await _make_request(session, url)):
+                return
+
+            diary = BeautifulSoup(response, features="html.parser")
+            rows = diary.find_all("tr", class_="diary-entry-row")
+            if not rows:
+                user_feed.truncated = False
+                return
+
+            logs = []
+            for row in rows:
+                try:
+                    logs.append(DiaryLog(row, since.tzinfo))
+                except (AttributeError, KeyError, TypeError, ValueError):
+                    continue
+            if not logs:
+                return
+
+            for log in logs:
+                if log.published.date() <= since.date():
+                    user_feed.truncated = False
+                    return
+                if log.viewing_id not in seen and log.link not in seen:
+                    user_feed.append(log)
+
+    @staticmethod
+    async def _get_advanced_metadata(
+        user_feed: UserFeed, connections: int, deadline: Deadline
+    ) -> None:
+        connector = aiohttp.TCPConnector(limit=connections)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            tasks = [log.get_advanced_metadata(session) for log in user_feed]
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(*tasks), deadline.remaining("metadata")
+                )
+            except asyncio.TimeoutError:
+                deadline.shed.add("metadata")
+
     @staticmethod
     def _is_entry_new(entry: PageElement, cutoff_time: datetime) -> bool:
-        # Example timestamp: "Thu, 19 Sep 2024 10:32:31 +1200"
-        entry_timestamp = entry.find("pubDate").text  # type: ignore
-        timestamp = datetime.strptime(entry_timestamp, "%a, %d %b %Y %H:%M:%S %z")
-        return timestamp > cutoff_time
+        return _published(entry) > cutoff_time
 
 
-async def create_memes(feeds: list[UserFeed]):
+async def create_memes(
+    feeds: list[UserFeed], deadline: Deadline | None = None, **encoding
+):
+    deadline = deadline or Deadline()
     originating_feeds = []
     creators = []
     poster_urls = []
+    posters = []
 
-    if feeds:
+    if feeds and deadline.allows("memes"):
         for feed in feeds:
             for entry in feed:
                 if isinstance(entry, MovieLog) and entry.rating and entry.poster_url:
@@ -324,15 +620,43 @@ async def create_memes(feeds: list[UserFeed]):
                             continue
                     originating_feeds.append(feed)
                     poster_urls.append(entry.poster_url)
-        posters = await _fetch_all(poster_urls)
+
+        missing = []
+        for url in dict.fromkeys(poster_urls):
+            if url in _posters:
+                _posters.move_to_end(url)
+            else:
+                missing.append(url)
+        responses = await _fetch_all(
+            missing, timeout=deadline.remaining("memes")
+        )
+        for url, poster in zip(missing, responses):
+            if poster:
+                _posters[url] = poster
+
+        posters = [_posters.get(url) for url in poster_urls]
+        while len(_posters) > _POSTERS_SIZE:
+            _posters.popitem(last=False)
 
     pictures = []
     for feed, creator, poster in zip(originating_feeds, creators, posters):
-        pictures.append(creator(feed.name, io.BytesIO(poster)))
+        if not deadline.allows("memes"):
+            break
+        if poster:
+            pictures.append(creator(feed.name, io.BytesIO(poster), **encoding))
 
     return pictures
 
 
+def get_state() -> dict:
+    return {"validators": _validators, "posters": _posters}
+
+
+def set_state(state: dict) -> None:
+    _validators.update(state.get("validators", {}))
+    _posters.update(state.get("posters", {}))
+
+
 def letterboxd_to_link(url: str) -> str | None:
     letterboxd_or_boxd = requests.get(url)
     if letterboxd_or_boxd.status_code == 200:
@@ -354,22 +678,52 @@ def letterboxd_to_link(url: str) -> str | None:
             )
 
 
-async def _make_request(session: aiohttp.ClientSession, url):
+async def _make_request(session: aiohttp.ClientSession, url, validators=None):
+    headers = {}
+    if validators is not None and url in validators:
+        etag, last_modified, _ = validators[url]
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
     try:
-        async with session.get(url) as response:
-            if response.status == 200:
-                return await response.read()
+        async with session.get(url, headers=headers) as response:
+            if response.status == 304:
+                return validators[url][2]  # type: ignore
+            elif response.status == 200:
+                body = await response.read()
+                etag = response.headers.get("ETag")
+                last_modified = response.headers.get("Last-Modified")
+                if validators is not None and (etag or last_modified):
+                    validators[url] = etag, last_modified, body
+                return body
             else:
                 print(response.status, url)
     except Exception as e:
         print(e)
 
 
-async def _fetch_all(urls: list[str]) -> list:
+async def _fetch_all(
+    urls: list[str],
+    connections: int = _CONNECTIONS,
+    validators: dict | None = None,
+    timeout: float | None = None,
+) -> list:
     responses = []
 
-    async with aiohttp.ClientSession() as session:
-        tasks = [_make_request(session, url) for url in urls]
+    connector = aiohttp.TCPConnector(limit=connections)
+    total = _DEFAULT_TIMEOUT if timeout is None else max(timeout, _MIN_TIMEOUT)
+    async with aiohttp.ClientSession(
+        connector=connector, timeout=aiohttp.ClientTimeout(total=total)
+    ) as session:
+        tasks = [_make_request(session, url, validators) for url in urls]
         responses = await asyncio.gather(*tasks)
 
     return responses
+
+
+def _published(entry: PageElement) -> datetime:
+    # Example timestamp: "Thu, 19 Sep 2024 10:32:31 +1200"
+    timestamp = entry.find("pubDate").text  # type: ignore
+    return datetime.strptime(timestamp, "%a, %d %b %Y %H:%M:%S %z")
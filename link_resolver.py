@@ -0,0 +1,101 @@
+import asyncio
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable
+
+
+class LinkResolver:
+    """
+    Resolves links on a fixed number of workers, taking turns between chats
+    so that a busy chat can't hold up the others. A link that is already
+    queued, in flight or recently resolved isn't resolved again. Links that
+    failed to resolve aren't cached, the failure may be temporary.
+
+    Attributes
+    ----------
+    per_chat : int
+    """
+
+    def __init__(
+        self,
+        resolve: Callable[[str], Awaitable[str | None]],
+        loop: asyncio.AbstractEventLoop,
+        per_chat: int = 10,
+        cache_size: int = 256,
+    ) -> None:
+        self.per_chat = per_chat
+        self._resolve = resolve
+        self._loop = loop
+        self._cache_size = cache_size
+        self._resolved: OrderedDict[str, str] = OrderedDict()
+        self._pending: dict[str, asyncio.Future] = {}
+        self._queues: dict[int, deque[str]] = {}
+        self._turns: deque[int] = deque()
+        self._ready = asyncio.Event()
+
+    def start(self, workers: int = 2) -> None:
+        for _ in range(workers):
+            self._loop.create_task(self._work())
+
+    def submit(self, chat_id: int, url: str) -> asyncio.Future | None:
+        """Returns None when the chat already has too many links queued."""
+        if url in self._pending:
+            return self._pending[url]
+
+        future = asyncio.get_running_loop().create_future()
+        if url in self._resolved:
+            self._resolved.move_to_end(url)
+            future.set_result(self._resolved[url])
+            return future
+
+        queue = self._queues.setdefault(chat_id, deque())
+        if len(queue) >= self.per_chat:
+            return None
+        if not queue:
+            self._turns.append(chat_id)
+
+        queue.append(url)
+        self._pending[url] = future
+        self._ready.set()
+        return future
+
+    async def _work(self) -> None:
+        while True:
+            while not self._turns:
+                self._ready.clear()
+                await self._ready.wait()
+
+            chat_id = self._turns.popleft()
+            queue = self._queues[chat_id]
+            url = queue.popleft()
+            if queue:
+                self._turns.append(chat_id)
+            else:
+                del self._queues[chat_id]
+
+            future = self._pending[url]
+            try:
+                link = await self._resolve(url)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(link)
+                if link:
+                    self._remember(url, link)
+            finally:
+                del self._pending[url]
+
+    def get_state(self) -> dict:
+        return {"resolved": self._resolved}
+
+    def set_state(self, state: dict) -> None:
+        # Older snapshots cached failures as well.
+        resolved = state.get("resolved", {})
+        self._resolved.update((url, link) for url, link in resolved.items() if link)
+
+    def _remember(self, url: str, link: str) -> None:
+        self._resolved[url] = link
+        if len(self._resolved) > self._cache_size:
+            self._resolved.popitem(last=False)
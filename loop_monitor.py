@@ -0,0 +1,92 @@
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+
+class LoopMonitor:
+    """
+    Measures how late the event loop wakes up from a short sleep, and from a
+    separate thread reports the task and stack of anything that keeps the
+    loop busy for longer than the threshold.
+
+    Attributes
+    ----------
+    interval : float
+    threshold : float
+    blocks : deque[str]
+    block_count : int
+    """
+
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        threshold: float = 0.5,
+        interval: float = 0.1,
+        samples: int = 3000,
+    ) -> None:
+        self.interval = interval
+        self.threshold = threshold
+        self.blocks = deque(maxlen=10)
+        self.block_count = 0
+        self._loop = loop
+        self._lags = deque(maxlen=samples)
+        self._heartbeat = time.monotonic()
+        self._loop_thread = None
+
+    def start(self) -> None:
+        """Must be called from the thread that runs the loop."""
+        self._loop_thread = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._loop.create_task(self._measure())
+        threading.Thread(target=self._watch, name="loop-monitor", daemon=True).start()
+
+    def stats(self) -> dict[str, float]:
+        lags = sorted(self._lags)
+        if not lags:
+            return {"p50": 0.0, "p99": 0.0, "max": 0.0}
+
+        return {
+            "p50": lags[len(lags) // 2],
+            "p99": lags[min(len(lags) - 1, len(lags) * 99 // 100)],
+            "max": lags[-1],
+        }
+
+    def format(self) -> str:
+        stats = self.stats()
+        lags = ", ".join(f"{key} {value * 1000:.0f} ms" for key, value in stats.items())
+        last_block = f"\n\n{self.blocks[-1]}" if self.blocks else ""
+        return f"Loop lag: {lags}, blocked {self.block_count} times{last_block}"
+
+    async def _measure(self) -> None:
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self._heartbeat = time.monotonic()
+            self._lags.append(max(0.0, self._heartbeat - start - self.interval))
+
+    def _watch(self) -> None:
+        reported = None
+        while True:
+            time.sleep(self.interval)
+            heartbeat = self._heartbeat
+            blocked = time.monotonic() - heartbeat - self.interval
+
+            # One report per blocking episode, taken while it's still blocked.
+            if blocked > self.threshold and reported != heartbeat:
+                reported = heartbeat
+                self._report(blocked)
+
+    def _report(self, blocked: float) -> None:
+        frame = sys._current_frames().get(self._loop_thread)  # type: ignore
+        stack = "".join(traceback.format_stack(frame, limit=12)) if frame else ""
+
+        task = asyncio.current_task(self._loop)
+        coroutine = task.get_coro().__qualname__ if task else "callback"  # type: ignore
+
+        block = f"Blocked for {blocked:.2f}s+ in {coroutine}:\n{stack}"
+        self.blocks.append(block)
+        self.block_count += 1
+        print(block)
@@ -1,24 +1,116 @@
 import io
 import re
+from collections import OrderedDict
+from functools import cache
 from random import choice
 from string import punctuation
 
 from PIL import Image, ImageFont
 from pilmoji import Pilmoji
+from pilmoji.helpers import getsize
 from pilmoji.source import AppleEmojiSource
 
 with open("positive_texts.txt") as f:
     POSITIVE_TEXTS = f.read().split("\n\n")
 
+_EXTENSIONS = {"PNG": "png", "JPEG": "jpg", "WEBP": "webp"}
+_MIN_QUALITY = 30
+
+_FONT = "arial_bold.ttf"
+_TEXT_COLOR = (35, 35, 35)
+# Rendered text with its offset from the anchor, by (text, font, size, color,
+# line by line), so the same names and phrases are only rasterized once.
+_TEXT_LAYERS_SIZE = 256
+_text_layers: OrderedDict[tuple, tuple[Image.Image, int, int]] = OrderedDict()
+
+
+def _image_to_bytes(
+    image,
+    format="JPEG",
+    quality=85,
+    max_bytes=0,
+):
+    if image.mode == "RGBA" and format == "JPEG":
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+
+    bio = _encode(image, format, quality)
+    if format != "PNG" and max_bytes and bio.getbuffer().nbytes > max_bytes:
+        # The highest quality that still fits, or the lowest one if none does.
+        best = None
+        low, high = _MIN_QUALITY, quality - 1
+        while low <= high:
+            middle = (low + high) // 2
+            candidate = _encode(image, format, middle)
+            if candidate.getbuffer().nbytes <= max_bytes:
+                best, low = candidate, middle + 1
+            else:
+                high = middle - 1
+        bio = best or _encode(image, format, min(quality, _MIN_QUALITY))
 
-def _image_to_bytes(image):
-    bio = io.BytesIO()
-    bio.name = "image.png"
-    image.save(bio, format="PNG")
     bio.seek(0)
     return bio
 
 
+def _encode(image, format, quality):
+    bio = io.BytesIO()
+    bio.name = f"image.{_EXTENSIONS[format]}"
+    image.save(bio, format=format, quality=quality)
+    return bio
+
+
+@cache
+def _load_template(path):
+    template = Image.open(path).convert("RGBA")
+    if template.getchannel("A").getextrema() == (255, 255):
+        # Opaque templates don't need the alpha channel, which only slows down
+        # rendering and encoding.
+        return template.convert("RGB")
+    return template
+
+
+@cache
+def _font(size):
+    return ImageFont.truetype(_FONT, size=size)
+
+
+def _draw_text(image, position, text, size, line_by_line=False):
+    layer, x, y = _text_layer(text, size, _TEXT_COLOR, line_by_line)
+    image.paste(layer, (position[0] + x, position[1] + y), layer)
+
+
+def _text_layer(text, size, text_color, line_by_line):
+    key = (text, _FONT, size, text_color, line_by_line)
+    if key in _text_layers:
+        _text_layers.move_to_end(key)
+        return _text_layers[key]
+
+    font = _font(size)
+    width, height = getsize(f"{text}\n\n", font)
+    canvas = Image.new("RGBA", (width + size * 2, height + size * 2))
+    center = (canvas.width // 2, canvas.height // 2)
+
+    if line_by_line:
+        _draw_centered(canvas, center, text, font, text_color)
+    else:
+        Pilmoji(canvas, source=AppleEmojiSource).text(
+            center,
+            text,
+            font=font,
+            anchor="mm",
+            fill=text_color,
+        )
+
+    left, top, right, bottom = canvas.getbbox() or (0, 0, 1, 1)
+    layer = canvas.crop((left, top, right, bottom))
+    _text_layers[key] = layer, left - center[0], top - center[1]
+    if len(_text_layers) > _TEXT_LAYERS_SIZE:
+        _text_layers.popitem(last=False)
+
+    return _text_layers[key]
+
+
 def _draw_centered(image, position, text, font, text_color):
     lines = [*text.split("\n"), "\n"]
     for i, line in enumerate(lines):
@@ -35,57 +127,48 @@ def _draw_centered(image, position, text, font, text_color):
         )
 
 
-def create_high_rating_meme(username, poster):
+def create_high_rating_meme(username, poster, **encoding):
     username = _clean_name(username)
-    image = Image.open("good.png").convert("RGBA")
+    image = _load_template("good.png").copy()
     overlay_image = Image.open(poster)
     overlay_image = overlay_image.resize((220, int(220 * 3 / 2)))
     image.paste(overlay_image, (35, 150))
 
     username_position = (720, 515)
     text_position = (550, 260)
-    username_font = ImageFont.truetype("arial_bold.ttf", size=20)
-    text_font = ImageFont.truetype("arial_bold.ttf", size=26)
-    text_color = (35, 35, 35)
-
-    Pilmoji(image, source=AppleEmojiSource).text(
-        username_position,
-        username,
-        font=username_font,
-        anchor="mm",
-        fill=text_color,
-    )
-    _draw_centered(
+
+    _draw_text(image, username_position, username, size=20)
+    _draw_text(
         image,
         text_position,
         choice(POSITIVE_TEXTS),
-        text_font,
-        text_color,
+        size=26,
+        line_by_line=True,
     )
 
-    return _image_to_bytes(image)
+    return _image_to_bytes(image, **encoding)
 
 
-def create_low_rating_meme(name, poster):
+def create_low_rating_meme(name, poster, **encoding):
     name = _clean_name(name)
-    image = Image.open("bad.png").convert("RGBA")
+    image = _load_template("bad.png").copy()
     overlay_image = Image.open(poster)
     overlay_image = overlay_image.resize((220, int(220 * 3 / 2)))
     image.paste(overlay_image, (680, 148))
 
     username_position = (155, 475)
-    username_font = ImageFont.truetype("arial_bold.ttf", size=26)
-    text_color = (35, 35, 35)
-
-    Pilmoji(image, source=AppleEmojiSource).text(
-        username_position,
-        name,
-        font=username_font,
-        anchor="mm",
-        fill=text_color,
-    )
 
-    return _image_to_bytes(image)
+    _draw_text(image, username_position, name, size=26)
+
+    return _image_to_bytes(image, **encoding)
+
+
+def get_state():
+    return {"text_layers": _text_layers}
+
+
+def set_state(state):
+    _text_layers.update(state.get("text_layers", {}))
 
 
 def _clean_name(name):
@@ -0,0 +1,58 @@
+import copy
+
+from telethon.helpers import add_surrogate
+from telethon.types import TypeMessageEntity
+from telethon.utils import split_text
+
+
+def pack_messages(
+    messages: list[tuple[str, list[TypeMessageEntity]]],
+    limit: int = 4096,
+    max_entities: int = 100,
+    separator: str = "\n\n",
+) -> list[tuple[str, list[TypeMessageEntity]]]:
+    """
+    Greedily packs already parsed messages into as few Telegram messages as
+    possible, splitting only the ones that don't fit into a message alone.
+    Lengths and offsets are counted in UTF-16 code units, as Telegram does.
+    """
+    packed = []
+    texts, entities, length = [], [], 0
+    gap = len(add_surrogate(separator))
+
+    for text, message_entities in messages:
+        if len(add_surrogate(text)) > limit or len(message_entities) > max_entities:
+            pieces = split_text(
+                text,
+                message_entities,
+                limit=limit,
+                max_entities=max_entities,
+                split_at=(r"\n\n", r"\n"),
+            )
+        else:
+            pieces = [(text, message_entities)]
+
+        for piece, piece_entities in pieces:
+            size = len(add_surrogate(piece))
+            if texts and (
+                length + gap + size > limit
+                or len(entities) + len(piece_entities) > max_entities
+            ):
+                packed.append((separator.join(texts), entities))
+                texts, entities, length = [], [], 0
+
+            offset = length + gap if texts else 0
+            for entity in piece_entities:
+                if offset:
+                    # Parsed feeds are cached, so their entities stay untouched.
+                    entity = copy.copy(entity)
+                    entity.offset += offset
+                entities.append(entity)
+
+            texts.append(piece)
+            length = offset + size
+
+    if texts:
+        packed.append((separator.join(texts), entities))
+
+    return packed
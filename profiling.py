@@ -0,0 +1,93 @@
+import cProfile
+import pstats
+from contextlib import asynccontextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Awaitable, Callable
+
+Reporter = Callable[[Path, str], Awaitable[None]]
+
+
+class Profiler:
+    """
+    Profiles the next N runs of a kind of work (e.g. "cycle" or "link") with
+    cProfile and dumps every run to a timestamped .pstats file, which
+    snakeviz, flameprof or gprof2dot can turn into a flame graph.
+
+    cProfile sees everything the event loop runs in the meantime, not only
+    the profiled coroutine, so concurrent handlers show up as well.
+
+    Attributes
+    ----------
+    directory : Path
+    """
+
+    def __init__(self, directory: str = "profiles") -> None:
+        self.directory = Path(directory)
+        self._remaining: dict[str, int] = {}
+        self._reporters: dict[str, Reporter | None] = {}
+        self._active = False
+
+    def arm(self, kind: str, count: int, report: Reporter | None = None) -> None:
+        self._remaining[kind] = count
+        self._reporters[kind] = report
+
+    def armed(self, kind: str) -> bool:
+        return not self._active and bool(self._remaining.get(kind))
+
+    def profiled(self, kind: str):
+        def decorator(func):
+            async def wrapper(*args, **kwargs):
+                async with self.profile(kind):
+                    return await func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    @asynccontextmanager
+    async def profile(self, kind: str):
+        # Only one cProfile can be enabled at a time.
+        if not self.armed(kind):
+            yield
+            return
+
+        self._remaining[kind] -= 1
+        self._active = True
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._active = False
+            path, summary = self._dump(kind, profile)
+
+        if report := self._reporters.get(kind):
+            await report(path, summary)
+        else:
+            print(f"{path}\n{summary}")
+
+    def _dump(self, kind: str, profile: cProfile.Profile) -> tuple[Path, str]:
+        self.directory.mkdir(exist_ok=True)
+        path = self.directory / f"{kind}-{datetime.now():%Y%m%d-%H%M%S-%f}.pstats"
+        profile.dump_stats(path)
+        return path, self._summarize(pstats.Stats(profile))
+
+    @staticmethod
+    def _summarize(stats: pstats.Stats, limit: int = 10) -> str:
+        hottest = sorted(
+            stats.stats.items(),  # type: ignore
+            key=lambda item: item[1][2],
+            reverse=True,
+        )[:limit]
+
+        lines = [f"{stats.total_tt * 1000:.0f} ms, own / cumulative / calls:"]  # type: ignore
+        for (file, line, func), (_, calls, own, cumulative, _) in hottest:
+            location = f"{Path(file).name}:{line}" if line else file
+            lines.append(
+                f"{own * 1000:7.1f} {cumulative * 1000:7.1f} {calls:>6}"
+                f"  {func} ({location})"
+            )
+
+        return "\n".join(lines)
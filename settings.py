@@ -1,8 +1,13 @@
+import json
 import os
+from datetime import datetime
 
 from dotenv import load_dotenv
 
 users_file = "users.txt"
+delivered_file = "delivered.json"
+snapshot_file = "snapshot.bin"
+outbox_file = "outbox.bin"
 load_dotenv("prod.env")
 
 
@@ -27,9 +32,51 @@ def save_users(users_file: str = users_file) -> None:
         f.write("\n".join(users))
 
 
+def mark_delivered(user: str, timestamp: datetime) -> None:
+    if user not in delivered or timestamp > delivered[user]:
+        delivered[user] = timestamp
+
+
+def load_delivered(delivered_file: str = delivered_file) -> dict[str, datetime]:
+    try:
+        with open(delivered_file) as f:
+            return {
+                user: datetime.fromisoformat(timestamp)
+                for user, timestamp in json.load(f).items()
+            }
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        print(f"{delivered_file} skipped: {e}")
+        return {}
+
+
+def save_delivered(delivered_file: str = delivered_file) -> None:
+    # Written aside first, so a kill mid-write keeps the previous file.
+    temporary = f"{delivered_file}.tmp"
+    with open(temporary, "w") as f:
+        json.dump({user: time.isoformat() for user, time in delivered.items()}, f)
+    os.replace(temporary, delivered_file)
+
+
 users = load_users()
+delivered = load_delivered()
 session = os.getenv("SESSION")
 api_id = int(os.getenv("API_ID"))  # type: ignore
 api_hash = os.getenv("API_HASH")
 phone_number = os.getenv("PHONE_NUMBER")
 chat_id = int(os.getenv("CHAT_ID"))  # type: ignore
+owner = int(os.getenv("OWNER_ID") or 0) or "me"
+link_chats = [int(chat) for chat in os.getenv("LINK_CHATS", "").split(",") if chat]
+meme_format = (os.getenv("MEME_FORMAT") or "JPEG").upper()
+meme_quality = int(os.getenv("MEME_QUALITY") or 85)
+meme_max_bytes = int(os.getenv("MEME_MAX_BYTES") or 0)
+if meme_format not in ("PNG", "JPEG", "WEBP"):
+    raise ValueError(f"MEME_FORMAT must be PNG, JPEG or WEBP, not {meme_format}")
+if not 1 <= meme_quality <= 100:
+    raise ValueError(f"MEME_QUALITY must be from 1 to 100, not {meme_quality}")
+meme_encoding = {
+    "format": meme_format,
+    "quality": meme_quality,
+    "max_bytes": meme_max_bytes,
+}
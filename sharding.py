@@ -0,0 +1,227 @@
+import asyncio
+import bisect
+import hashlib
+import io
+import multiprocessing
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from multiprocessing.connection import Connection
+
+import letterboxd
+import memes
+import settings
+import snapshot
+
+
+class ShardRing:
+    """
+    Consistent hash ring, so changing the number of shards only moves the
+    users between the old and the new shards.
+
+    Attributes
+    ----------
+    shards : int
+    """
+
+    def __init__(self, shards: int, replicas: int = 100) -> None:
+        self.shards = shards
+        self._ring = sorted(
+            (_hash(f"{shard}:{replica}"), shard)
+            for shard in range(shards)
+            for replica in range(replicas)
+        )
+        self._keys = [key for key, _ in self._ring]
+
+    def shard_of(self, username: str) -> int:
+        index = bisect.bisect(self._keys, _hash(username)) % len(self._keys)
+        return self._ring[index][1]
+
+    def assign(self, usernames: list[str]) -> dict[int, list[str]]:
+        shards = {}
+        for username in usernames:
+            shards.setdefault(self.shard_of(username), []).append(username)
+        return shards
+
+
+class ShardedUpdatesManager:
+    """
+    Runs RssUpdatesManager.prepare_updates for every shard of the users in
+    its own worker process, while the caller keeps the Telegram client and
+    delivers the results.
+
+    The workers are forked once, so the manager has to be created before the
+    client connects and before any thread starts: a child would inherit the
+    sockets and any lock another thread holds. For the same reason, adding
+    workers takes a restart: resizing only spreads the users over fewer or
+    more of the workers started at launch. A shard whose worker died is
+    prepared in-process instead of forking a new worker, and a worker that
+    misses the cycle's deadline is left out of that cycle.
+
+    Attributes
+    ----------
+    age : int
+    workers : int
+    """
+
+    def __init__(self, max_age_minutes: int, workers: int) -> None:
+        self.age = max_age_minutes
+        self.workers = workers
+        # Forked workers don't re-run bot.py, which starts the client on import.
+        context = multiprocessing.get_context("fork")
+        self._workers: list[tuple[multiprocessing.Process, Connection]] = []
+        for shard in range(workers):
+            connection, worker_connection = context.Pipe()
+            process = context.Process(
+                target=_work,
+                args=(worker_connection, shard),
+                name=f"letterboxd-shard-{shard}",
+                daemon=True,
+            )
+            process.start()
+            worker_connection.close()
+            self._workers.append((process, connection))
+
+        self._locks = [threading.Lock() for _ in range(workers)]
+        # Answers to requests that missed their deadline, still due on the pipe.
+        self._late = [0] * workers
+        # Waiting for the workers doesn't take threads from the loop's default
+        # executor, which resolves links in the meantime.
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="shard")
+        self.resize(workers)
+
+    def resize(self, workers: int) -> None:
+        """
+        Takes effect from the next prepare_updates call. At most as many
+        shards as workers were started, the rest of them are kept idle so the
+        pool can grow back.
+        """
+        if not 0 < workers <= self.workers:
+            raise ValueError(f"1 to {self.workers} shards, not {workers}")
+        self._ring = ShardRing(workers)
+
+    async def prepare_updates(
+        self,
+        usernames: list[str],
+        since: dict[str, datetime] | None = None,
+        digest: bool = False,
+        deadline: letterboxd.Deadline | None = None,
+    ) -> tuple[list[letterboxd.UserFeed], list[io.BytesIO]]:
+        loop = asyncio.get_running_loop()
+        ring = self._ring
+        since = since or {}
+        deadline = deadline or letterboxd.Deadline()
+
+        requests = []
+        for shard, shard_usernames in ring.assign(usernames).items():
+            shard_since = {
+                user: since[user] for user in shard_usernames if user in since
+            }
+            request = (self.age, shard_usernames, shard_since, digest, deadline)
+            if self._workers[shard][0].is_alive():
+                requests.append(
+                    loop.run_in_executor(self._executor, self._request, shard, request)
+                )
+            else:
+                requests.append(self._prepare_here(shard, request))
+        results = await asyncio.gather(*requests)
+
+        updates, pictures = [], []
+        for (shard_updates, shard_pictures), shed in results:
+            updates.extend(shard_updates)
+            pictures.extend(shard_pictures)
+            deadline.shed |= shed
+
+        return updates, pictures
+
+    def close(self, timeout: float = 10) -> None:
+        """
+        Workers snapshot their caches when terminated. The ones that haven't
+        exited within the timeout are killed.
+        """
+        for process, _ in self._workers:
+            process.terminate()
+
+        expires_at = time.monotonic() + timeout
+        for process, connection in self._workers:
+            process.join(max(0.0, expires_at - time.monotonic()))
+            if process.is_alive():
+                process.kill()
+                process.join()
+            connection.close()
+        self._workers.clear()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _prepare_here(
+        self, shard: int, request: tuple
+    ) -> tuple[tuple[list, list], set]:
+        # Forking from the running bot isn't safe, so it stays this way until
+        # the next restart. What was shed is recorded in the deadline directly.
+        print(f"{self._workers[shard][0].name} is dead, preparing it in-process")
+        age, *arguments = request
+        manager = letterboxd.RssUpdatesManager(age, settings.meme_encoding)
+        return await manager.prepare_updates(*arguments), set()
+
+    def _request(self, shard: int, request: tuple) -> tuple[tuple[list, list], set]:
+        # A cancelled cycle may still wait for its answer on the same pipe.
+        with self._locks[shard]:
+            process, connection = self._workers[shard]
+            deadline = request[-1]
+            try:
+                connection.send(request)
+                while connection.poll(deadline.remaining()):
+                    answer = connection.recv()
+                    if not self._late[shard]:
+                        return answer
+                    self._late[shard] -= 1
+            except (EOFError, OSError) as e:
+                print(process.name, e)
+                return ([], []), set()
+
+            # The other shards' updates aren't held up, this one comes late.
+            self._late[shard] += 1
+            return ([], []), {f"shard {shard}"}
+
+
+def _work(connection: Connection, shard: int) -> None:
+    signal.signal(signal.SIGTERM, _exit)
+    signal.signal(signal.SIGINT, _exit)
+    signal.signal(signal.SIGHUP, _exit)
+
+    # A shard keeps mostly the same users, so it keeps its own caches.
+    snapshot_file = f"{settings.snapshot_file}.{shard}"
+    state = snapshot.load(snapshot_file)
+    letterboxd.set_state(state.get("letterboxd", {}))
+    memes.set_state(state.get("memes", {}))
+
+    manager = letterboxd.RssUpdatesManager(0, settings.meme_encoding)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    try:
+        while (request := connection.recv()) is not None:
+            # The age can change with >age while the worker keeps running.
+            manager.age, *request = request
+            # The deadline is a copy, so what was shed goes back separately.
+            deadline = request[-1]
+            try:
+                result = loop.run_until_complete(manager.prepare_updates(*request))
+            except Exception as e:
+                print(e)
+                result = [], []
+            connection.send((result, deadline.shed))
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        state = {"letterboxd": letterboxd.get_state(), "memes": memes.get_state()}
+        snapshot.save(snapshot_file, state)
+
+
+def _exit(signum, frame) -> None:
+    raise SystemExit(0)
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
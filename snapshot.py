@@ -0,0 +1,60 @@
+"""
+Versioned on-disk snapshots of in-memory caches for warm restarts.
+
+Layout: magic, version, payload length and its SHA-256, then the pickled
+payload. Anything that doesn't check out is ignored and the bot starts cold.
+"""
+
+import hashlib
+import mmap
+import os
+import pickle
+import struct
+
+VERSION = 1
+
+_MAGIC = b"LBXD"
+_HEADER = struct.Struct("<4sHQ32s")
+
+
+def save(path: str, state: dict) -> None:
+    payload = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+    header = _HEADER.pack(
+        _MAGIC, VERSION, len(payload), hashlib.sha256(payload).digest()
+    )
+
+    # Written aside first, so a crash mid-write keeps the previous snapshot.
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as f:
+        f.write(header)
+        f.write(payload)
+    os.replace(temporary, path)
+
+
+def load(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+
+    try:
+        with open(path, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as mapped:
+            return _parse(mapped)
+    except Exception as e:
+        print(f"Snapshot {path} skipped: {e}")
+        return {}
+
+
+def _parse(mapped: mmap.mmap) -> dict:
+    if len(mapped) < _HEADER.size:
+        raise ValueError("truncated header")
+
+    magic, version, length, digest = _HEADER.unpack_from(mapped)
+    if magic != _MAGIC or version != VERSION:
+        raise ValueError(f"unsupported version {version}")
+
+    # Checked and unpickled in place, without copying the payload.
+    with memoryview(mapped)[_HEADER.size :] as payload:
+        if len(payload) != length or hashlib.sha256(payload).digest() != digest:
+            raise ValueError("checksum mismatch")
+        return pickle.loads(payload)
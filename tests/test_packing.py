@@ -0,0 +1,56 @@
+from telethon.helpers import add_surrogate
+from telethon.types import MessageEntityBold, MessageEntityTextUrl
+
+from packing import pack_messages
+
+
+def _text_of(text, entity):
+    # Offsets and lengths are in UTF-16 code units.
+    utf16 = add_surrogate(text)
+    return utf16[entity.offset : entity.offset + entity.length]
+
+
+def test_offsets_are_shifted_in_utf16_after_an_emoji_feed():
+    first = ("🎬 Bob 🍿", [MessageEntityBold(offset=3, length=3)])
+    second = ("😀 Alice", [MessageEntityTextUrl(offset=3, length=5, url="x")])
+
+    [(text, entities)] = pack_messages([first, second])
+
+    assert text == "🎬 Bob 🍿\n\n😀 Alice"
+    assert [_text_of(text, entity) for entity in entities] == ["Bob", "Alice"]
+    assert entities[1].offset == len(add_surrogate("🎬 Bob 🍿\n\n😀 "))
+
+
+def test_cached_entities_are_not_modified():
+    entity = MessageEntityBold(offset=0, length=1)
+
+    pack_messages([("a", []), ("b", [entity])])
+
+    assert entity.offset == 0
+
+
+def test_starts_a_new_message_at_the_entity_limit():
+    feeds = [(f"f{i}", [MessageEntityBold(offset=0, length=2)]) for i in range(3)]
+
+    packed = pack_messages(feeds, max_entities=2)
+
+    assert [text for text, _ in packed] == ["f0\n\nf1", "f2"]
+    assert [len(entities) for _, entities in packed] == [2, 1]
+    assert packed[1][1][0].offset == 0
+
+
+def test_starts_a_new_message_at_the_length_limit():
+    packed = pack_messages([("🎬" * 3, []), ("abc", [])], limit=8)
+
+    # Six code units of emoji and two of separator leave no room for "abc".
+    assert [text for text, _ in packed] == ["🎬" * 3, "abc"]
+
+
+def test_splits_a_message_that_does_not_fit_alone():
+    text = "\n\n".join(["x" * 6] * 3)
+
+    packed = pack_messages([(text, [])], limit=10)
+
+    assert len(packed) == 3
+    assert all(len(text) <= 10 for text, _ in packed)
+    assert [text.strip() for text, _ in packed] == ["x" * 6] * 3
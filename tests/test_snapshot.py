@@ -0,0 +1,48 @@
+import snapshot
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "snapshot.bin")
+    state = {"links": {"https://boxd.it/x": "https://example.com"}, "outbox": []}
+
+    snapshot.save(path, state)
+
+    assert snapshot.load(path) == state
+
+
+def test_missing_file_is_a_cold_start(tmp_path):
+    assert snapshot.load(str(tmp_path / "snapshot.bin")) == {}
+
+
+def test_corrupted_payload_is_ignored(tmp_path):
+    path = tmp_path / "snapshot.bin"
+    snapshot.save(str(path), {"links": {"a": "b"}})
+    data = bytearray(path.read_bytes())
+    data[-1] ^= 0xFF
+    path.write_bytes(data)
+
+    assert snapshot.load(str(path)) == {}
+
+
+def test_truncated_payload_is_ignored(tmp_path):
+    path = tmp_path / "snapshot.bin"
+    snapshot.save(str(path), {"links": {"a": "b"}})
+    path.write_bytes(path.read_bytes()[:-5])
+
+    assert snapshot.load(str(path)) == {}
+
+
+def test_truncated_header_is_ignored(tmp_path):
+    path = tmp_path / "snapshot.bin"
+    snapshot.save(str(path), {"links": {"a": "b"}})
+    path.write_bytes(path.read_bytes()[:10])
+
+    assert snapshot.load(str(path)) == {}
+
+
+def test_other_version_is_ignored(tmp_path, monkeypatch):
+    path = str(tmp_path / "snapshot.bin")
+    snapshot.save(path, {"links": {"a": "b"}})
+    monkeypatch.setattr(snapshot, "VERSION", snapshot.VERSION + 1)
+
+    assert snapshot.load(path) == {}